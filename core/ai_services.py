@@ -1,24 +1,65 @@
 # core/ai_services.py
 import os
+import re
+import random
+import asyncio
+import logging
+from functools import lru_cache, partial
+import httpx
+import openai
 from openai import AsyncOpenAI
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from fastapi import HTTPException
 from typing import AsyncGenerator
 from core.models import MODELS
+from core.cache import LLMCache, SemanticCache
+from core.prompts import MAX_TOKENS_PAGE
+logger = logging.getLogger(__name__)
 # --- Environment Setup ---
 TOGETHER_API_KEY = os.environ.get("TOGETHER_API_KEY")
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-together_client = AsyncOpenAI(api_key=TOGETHER_API_KEY, base_url="https://api.together.xyz/v1")
+# A single pooled HTTP/2 client shared by every request, so connections to the
+# provider stay warm instead of paying a TLS handshake per call.
+# The transport retries a failed connect once, so a stale or refused connection
+# does not surface as an error; it never resends a request that was delivered.
+http_client = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=1,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=300),
+    ),
+    # The OpenAI SDK adopts this client's timeout; the read limit matches the
+    # SDK's own 600s default, which a long non-streamed generation can need.
+    timeout=httpx.Timeout(600.0, connect=10.0),
+)
+# Retries are handled by _call_provider for every provider alike.
+together_client = AsyncOpenAI(api_key=TOGETHER_API_KEY, base_url="https://api.together.xyz/v1", http_client=http_client, max_retries=0)
 if GOOGLE_API_KEY:
     genai.configure(api_key=GOOGLE_API_KEY)
+response_cache = LLMCache(
+    max_entries=int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 512)),
+    ttl_seconds=float(os.environ.get("LLM_CACHE_TTL_SECONDS", 3600)),
+)
+# Near-duplicate lookup for prompt-only builds; off unless SEMANTIC_CACHE=1,
+# since it needs sentence-transformers and a local embedding model.
+semantic_cache = SemanticCache(
+    threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.92)),
+) if os.environ.get("SEMANTIC_CACHE") == "1" else None
+# Non-streamed calls currently in flight, keyed like the response cache, so that
+# concurrent duplicate requests share a single upstream call.
+_inflight: dict[str, asyncio.Task] = {}
+_HTML_CLOSE_RE = re.compile(r'</html>', re.IGNORECASE)
+# Sampling temperature for Together calls that do not pass their own.
+DEFAULT_TEMPERATURE = 0.2
 # --- Private API Call Functions ---
-async def _generate_with_together(system_prompt: str, user_prompt: str, model_api_id: str, stream: bool = False):
+async def _generate_with_together(system_prompt: str, user_prompt: str, model_api_id: str, stream: bool = False, max_tokens: int = MAX_TOKENS_PAGE, temperature: float | None = None):
     try:
         response_stream = await together_client.chat.completions.create(
             model=model_api_id,
             messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-            temperature=0.2,
-            max_tokens=8192,
+            temperature=DEFAULT_TEMPERATURE if temperature is None else temperature,
+            max_tokens=max_tokens,
             stream=stream
         )
         if stream:
@@ -32,52 +73,219 @@ async def _generate_with_together(system_prompt: str, user_prompt: str, model_ap
             # This is not a stream, so we await the single result
             return response_stream.choices[0].message.content or ""
     except Exception as e:
-        print(f"Together AI Error: {e}")
+        logger.error("Together AI Error: %s", e)
         raise HTTPException(status_code=502, detail=f"Together AI service error: {str(e)}")
-async def _generate_with_google(system_prompt: str, user_prompt: str, model_api_id: str, stream: bool = False):
-    if stream:
-        async def stream_placeholder():
-            response_text = await _generate_with_google(system_prompt, user_prompt, model_api_id, stream=False)
-            yield response_text
-        return stream_placeholder()
+_GOOGLE_SAFETY_SETTINGS = { 'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE', 'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE', 'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_NONE', 'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE'}
+@lru_cache(maxsize=16)
+def _gemini_model(model_api_id: str, system_prompt: str) -> genai.GenerativeModel:
+    # System prompts are a few module constants, so this holds one model per
+    # (model, prompt) pair instead of rebuilding it on every call.
+    return genai.GenerativeModel(model_api_id, system_instruction=system_prompt)
+async def _generate_with_google(system_prompt: str, user_prompt: str, model_api_id: str, stream: bool = False, max_tokens: int = MAX_TOKENS_PAGE, temperature: float | None = None):
     if not GOOGLE_API_KEY:
         raise HTTPException(status_code=503, detail="Google API key not configured.")
     try:
-        model = genai.GenerativeModel(model_api_id)
-        full_prompt = f"{system_prompt}\n\nUSER PROMPT: {user_prompt}"
-        safety_settings = { 'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE', 'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_NONE', 'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_NONE', 'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_NONE'}
-        
-        response = await model.generate_content_async(full_prompt, safety_settings=safety_settings)
+        # Pass the system prompt as the model's system instruction so every call
+        # shares an identical prefix that the provider can cache; only the
+        # user prompt varies.
+        model = _gemini_model(model_api_id, system_prompt)
+        generation_config = {"max_output_tokens": max_tokens}
+        if temperature is not None:
+            generation_config["temperature"] = temperature
+        response = await model.generate_content_async(
+            user_prompt,
+            safety_settings=_GOOGLE_SAFETY_SETTINGS,
+            generation_config=generation_config,
+            stream=stream
+        )
+        if stream:
+            async def stream_generator():
+                async for chunk in response:
+                    try:
+                        content = chunk.text
+                    except ValueError:
+                        # Chunks without text parts (e.g. a bare finish reason) have no .text
+                        continue
+                    if content:
+                        yield content
+            return stream_generator()
         return response.text
     except Exception as e:
-        print(f"Google AI Error: {e}")
+        logger.error("Google AI Error: %s", e)
         raise HTTPException(status_code=502, detail=f"Google AI service error: {str(e)}")
+# Upstream failures worth another attempt: dropped connections, rate limits and
+# provider-side 5xx. Anything else (bad request, auth) fails straight away.
+_TRANSIENT_ERRORS = (
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+# A non-streamed call that timed out had the whole generation running; retrying
+# it would pay for the generation again and likely time out again.
+_TIMEOUT_ERRORS = (openai.APITimeoutError, google_exceptions.DeadlineExceeded)
+_MAX_ATTEMPTS = 3
+_RETRY_BASE_DELAY = 0.5
+# Bounds the wait for a stream's first response; retried like a dropped connection.
+_STREAM_START_TIMEOUT = 240.0
+# Bounds a whole non-streamed generation. Kept above the HTTP read timeout so the
+# SDK's own timeout normally fires first; never retried.
+_GENERATION_TIMEOUT = 660.0
+# Caps how many upstream requests a worker opens at once, so a burst queues here
+# instead of tripping the provider's rate limit for every request at once. A
+# non-streamed call holds its slot until the full response arrives; a stream
+# holds it only until the provider starts responding, so the streams still
+# being read are not counted.
+_upstream_slots = asyncio.Semaphore(int(os.environ.get("MAX_UPSTREAM_CALLS", 64)))
+async def _call_provider(provider_func, system_prompt: str, user_prompt: str, model_api_id: str, stream: bool, max_tokens: int, temperature: float | None = None):
+    """
+    The single place every upstream call goes through: bounds each attempt with
+    a timeout and retries transient failures with full-jitter exponential backoff.
+    """
+    for attempt in range(1, _MAX_ATTEMPTS + 1):
+        try:
+            async with _upstream_slots:
+                return await asyncio.wait_for(
+                    provider_func(system_prompt, user_prompt, model_api_id, stream=stream, max_tokens=max_tokens, temperature=temperature),
+                    _STREAM_START_TIMEOUT if stream else _GENERATION_TIMEOUT,
+                )
+        except asyncio.TimeoutError:
+            if not stream:
+                raise HTTPException(status_code=504, detail="AI service timed out before the response was complete.")
+            if attempt == _MAX_ATTEMPTS:
+                raise HTTPException(status_code=504, detail=f"AI service timed out after {_MAX_ATTEMPTS} attempts.")
+        except HTTPException as e:
+            # Provider functions wrap the SDK error, which stays reachable as __context__.
+            cause = e.__context__
+            if attempt == _MAX_ATTEMPTS or not isinstance(cause, _TRANSIENT_ERRORS):
+                raise
+            if not stream and isinstance(cause, _TIMEOUT_ERRORS):
+                raise
+        delay = random.uniform(0, _RETRY_BASE_DELAY * 2 ** (attempt - 1))
+        logger.warning("Upstream call to %s failed (attempt %d/%d); retrying in %.2fs", model_api_id, attempt, _MAX_ATTEMPTS, delay)
+        await asyncio.sleep(delay)
 # --- Public Dispatcher Functions ---
-async def generate_code(system_prompt: str, user_prompt: str, model_key: str) -> str:
-    model_config = MODELS.get(model_key)
-    if not model_config:
-        raise HTTPException(status_code=400, detail=f"Invalid model key: {model_key}")
-    
-    provider_map = {
-        "together": _generate_with_together,
-        "google": _generate_with_google
-    }
-    provider_func = provider_map.get(model_config["api_provider"])
-    if not provider_func:
+_PROVIDER_FUNCS = {
+    "together": _generate_with_together,
+    "google": _generate_with_google
+}
+# (provider function, provider model id) per model key, resolved once at import.
+_MODEL_ROUTES = {
+    model_key: (_PROVIDER_FUNCS[config["api_provider"]], config["api_id"])
+    for model_key, config in MODELS.items()
+    if config["api_provider"] in _PROVIDER_FUNCS
+}
+def _resolve_model(model_key: str):
+    route = _MODEL_ROUTES.get(model_key)
+    if route is None:
+        if model_key not in MODELS:
+            raise HTTPException(status_code=400, detail=f"Invalid model key: {model_key}")
         raise HTTPException(status_code=500, detail=f"Unknown provider for model '{model_key}'")
-    return await provider_func(system_prompt, user_prompt, model_config["api_id"], stream=False)
-def stream_code(system_prompt: str, user_prompt: str, model_key: str):
-    """Returns a coroutine that, when awaited, produces an async generator for streaming."""
-    model_config = MODELS.get(model_key)
-    if not model_config:
-        raise HTTPException(status_code=400, detail=f"Invalid model key: {model_key}")
-    provider_map = {
-        "together": _generate_with_together,
-        "google": _generate_with_google
-    }
-    provider_func = provider_map.get(model_config["api_provider"])
-    if not provider_func:
-        raise HTTPException(status_code=500, detail=f"Unknown provider for model '{model_key}'")
-    
+    return route
+# Rough characters-per-token ratio for HTML and English; only used to reject
+# prompts that clearly cannot fit, so it errs on the generous side.
+_CHARS_PER_TOKEN = 4
+def _check_context_window(model_key: str, system_prompt: str, user_prompt: str, max_tokens: int) -> None:
+    """Rejects a prompt that cannot fit the model's context before paying for the round trip."""
+    context_window = MODELS[model_key].get("context_window")
+    if not context_window:
+        return
+    approx_tokens = (len(system_prompt) + len(user_prompt)) // _CHARS_PER_TOKEN
+    if approx_tokens + max_tokens > context_window:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Request too large for {model_key}: about {approx_tokens} input tokens plus {max_tokens} output tokens exceeds its {context_window}-token context.",
+        )
+async def generate_code(system_prompt: str, user_prompt: str, model_key: str, max_tokens: int = MAX_TOKENS_PAGE, use_cache: bool = True, temperature: float | None = None, cache_result: bool = True) -> str:
+    """
+    Returns the model's full response. With use_cache=False a fresh response is
+    generated (and replaces any cached one) instead of reusing a cached or
+    in-flight result. With cache_result=False the response is not stored, e.g.
+    for candidates the caller may discard; see cache_response. `temperature`
+    overrides the provider's default sampling temperature.
+    """
+    provider_func, model_api_id = _resolve_model(model_key)
+    _check_context_window(model_key, system_prompt, user_prompt, max_tokens)
+    cache_key = LLMCache.make_key(model_api_id, system_prompt, user_prompt, max_tokens, temperature)
+    call = partial(_call_and_cache, cache_key if cache_result else None, provider_func, system_prompt, user_prompt, model_api_id, max_tokens, temperature)
+    if not use_cache:
+        return await call()
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    task = _inflight.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(call())
+        _inflight[cache_key] = task
+        task.add_done_callback(lambda _: _inflight.pop(cache_key, None))
+    # Shield the shared call so one disconnecting client does not cancel it for the others.
+    return await asyncio.shield(task)
+async def generate_code_batch(requests: list[dict], max_concurrency: int = 8) -> list:
+    """
+    Runs several generate_code calls concurrently, so N calls take about as long
+    as the slowest one. Each item holds generate_code's keyword arguments. A
+    failing item yields its exception in place instead of failing the batch.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async def run_one(kwargs: dict) -> str:
+        async with semaphore:
+            return await generate_code(**kwargs)
+    return await asyncio.gather(*(run_one(kwargs) for kwargs in requests), return_exceptions=True)
+def cache_response(system_prompt: str, user_prompt: str, model_key: str, max_tokens: int, response_text: str) -> None:
+    """Stores a response generated with cache_result=False, once the caller has decided to keep it."""
+    _, model_api_id = _resolve_model(model_key)
+    if response_text:
+        response_cache.set(LLMCache.make_key(model_api_id, system_prompt, user_prompt, max_tokens), response_text)
+async def _call_and_cache(cache_key: str | None, provider_func, system_prompt: str, user_prompt: str, model_api_id: str, max_tokens: int, temperature: float | None = None) -> str:
+    response_text = await _call_provider(provider_func, system_prompt, user_prompt, model_api_id, stream=False, max_tokens=max_tokens, temperature=temperature)
+    if response_text and cache_key is not None:
+        response_cache.set(cache_key, response_text)
+    return response_text
+def stream_code(system_prompt: str, user_prompt: str, model_key: str, max_tokens: int = MAX_TOKENS_PAGE, use_cache: bool = True, semantic_text: str | None = None):
+    """
+    Returns a coroutine that, when awaited, produces an async generator for streaming.
+    `semantic_text`, when given, is matched against earlier requests by meaning
+    (if the semantic cache is enabled); only pass it for prompts that fully
+    determine the output.
+    """
+    provider_func, model_api_id = _resolve_model(model_key)
+    _check_context_window(model_key, system_prompt, user_prompt, max_tokens)
+    cache_key = LLMCache.make_key(model_api_id, system_prompt, user_prompt, max_tokens)
     # Return the coroutine itself, NOT the awaited result.
-    return provider_func(system_prompt, user_prompt, model_config["api_id"], stream=True)
+    return _stream_with_cache(cache_key, provider_func, system_prompt, user_prompt, model_api_id, max_tokens, use_cache, semantic_text)
+async def _stream_with_cache(cache_key: str, provider_func, system_prompt: str, user_prompt: str, model_api_id: str, max_tokens: int, use_cache: bool = True, semantic_text: str | None = None):
+    """Replays a cached response as a one-chunk stream, or records a live stream into the cache."""
+    cached = response_cache.get(cache_key) if use_cache else None
+    semantic_vector = None
+    if cached is None and semantic_cache is not None and semantic_text:
+        # Everything but the free-text prompt must match exactly.
+        semantic_namespace = LLMCache.make_key(model_api_id, system_prompt, "", max_tokens)
+        semantic_vector = await asyncio.to_thread(semantic_cache.embed, semantic_text)
+        if use_cache:
+            cached = semantic_cache.get(semantic_namespace, semantic_vector)
+    if cached is not None:
+        async def replay_stream():
+            yield cached
+        return replay_stream()
+
+    ai_stream = await _call_provider(provider_func, system_prompt, user_prompt, model_api_id, stream=True, max_tokens=max_tokens)
+    async def recording_stream():
+        parts = []
+        try:
+            async for chunk in ai_stream:
+                parts.append(chunk)
+                yield chunk
+        finally:
+            response_text = "".join(parts)
+            # Only a full page is worth replaying: a reply cut off by max_tokens
+            # or a refusal without markup would come back on every retry. The
+            # page handler stops reading once </html> arrives, so a stream
+            # closed after that point still holds a complete response.
+            if _HTML_CLOSE_RE.search(response_text):
+                response_cache.set(cache_key, response_text)
+                if semantic_vector is not None:
+                    semantic_cache.set(semantic_namespace, semantic_vector, response_text)
+    return recording_stream()
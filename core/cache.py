@@ -0,0 +1,85 @@
+# core/cache.py
+import hashlib
+import threading
+import time
+import orjson
+from collections import OrderedDict, deque
+
+class LLMCache:
+    """
+    In-memory LRU cache of model responses, keyed by a hash of everything that
+    determines the output. Entries expire after `ttl_seconds`.
+    """
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def make_key(model_id: str, system_prompt: str, user_prompt: str, max_tokens: int, temperature: float | None = None) -> str:
+        fields = {"m": model_id, "s": system_prompt, "u": user_prompt, "t": max_tokens}
+        # Only an explicit temperature is keyed, so default-temperature keys stay as they were.
+        if temperature is not None:
+            fields["T"] = temperature
+        payload = orjson.dumps(fields, option=orjson.OPT_SORT_KEYS)
+        return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def set(self, key: str, value: str) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+class SemanticCache:
+    """
+    Opt-in near-duplicate cache for prompt-only page builds. Prompts are
+    embedded with a small local model and a stored response is reused when an
+    earlier prompt in the same namespace is similar enough. sentence-transformers
+    is imported on first use, so it is only needed when the cache is enabled.
+    """
+    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2", threshold: float = 0.92, max_entries: int = 1024):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._encoder = None
+        self._encoder_lock = threading.Lock()
+        self._entries: dict[str, deque] = {}
+        self.stats = {"hits": 0, "misses": 0}
+
+    def embed(self, text: str):
+        """Returns the normalized embedding of `text`. CPU-bound; call it from a worker thread."""
+        if self._encoder is None:
+            with self._encoder_lock:
+                if self._encoder is None:
+                    from sentence_transformers import SentenceTransformer
+                    self._encoder = SentenceTransformer(self.model_name)
+        return self._encoder.encode(text, normalize_embeddings=True)
+
+    def get(self, namespace: str, vector) -> str | None:
+        entries = self._entries.get(namespace)
+        if entries:
+            # Embeddings are normalized, so the dot product is the cosine similarity.
+            best_score, best_value = max(((float(stored @ vector), value) for stored, value in entries), key=lambda pair: pair[0])
+            if best_score >= self.threshold:
+                self.stats["hits"] += 1
+                return best_value
+        self.stats["misses"] += 1
+        return None
+
+    def set(self, namespace: str, vector, value: str) -> None:
+        entries = self._entries.get(namespace)
+        if entries is None:
+            entries = self._entries[namespace] = deque(maxlen=self.max_entries)
+        entries.append((vector, value))
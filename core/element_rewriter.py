@@ -1,8 +1,10 @@
 # core/element_rewriter.py
 import re
+import logging
 from bs4 import BeautifulSoup, Tag
 from core.ai_services import generate_code
 from core.prompts import SYSTEM_PROMPT_REWRITE_ELEMENT
+logger = logging.getLogger(__name__)
 def clean_ai_response(raw_text: str) -> str:
     """
     Rigorously cleans the AI's response to isolate ONLY the first valid HTML element,
@@ -26,7 +28,7 @@ def clean_ai_response(raw_text: str) -> str:
         if first_tag:
             return str(first_tag)
     except Exception as e:
-        print(f"BeautifulSoup parsing failed in clean_ai_response: {e}")
+        logger.warning("BeautifulSoup parsing failed in clean_ai_response: %s", e)
         # As a last resort for malformed output, use a simpler, non-greedy regex.
         tag_match = re.search(r'(<.*?>.*?</.*?>)', raw_text, re.DOTALL | re.IGNORECASE)
         if tag_match:
@@ -52,7 +54,7 @@ async def rewrite_element(prompt: str, selected_element_html: str, model: str) -
     rewritten_element = clean_ai_response(ai_response_text)
     
     if not rewritten_element:
-        print("Warning: AI returned an empty string for element rewrite.")
+        logger.warning("AI returned an empty string for element rewrite.")
         # Fallback to the original element to avoid deleting the user's content
         return selected_element_html
         
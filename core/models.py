@@ -1,23 +1,33 @@
 # core/models.py
-MODELS = {
-    "glm-4.5-air": {
+from types import MappingProxyType
+
+# Read-only views: the routing table in ai_services is derived from these once
+# at import, so they must not change afterwards.
+MODELS = MappingProxyType({
+    "glm-4.5-air": MappingProxyType({
         "label": "GLM 4.5 Air",
         "api_provider": "together",
         "api_id": "zai-org/GLM-4.5-Air-FP8",
-    },
-    "gemini-2.5-flash-lite": {
+        "context_window": 131072,
+        # Spends output tokens on reasoning before the answer.
+        "reasoning": True,
+    }),
+    "gemini-2.5-flash-lite": MappingProxyType({
         "label": "Gemini 2.5 Flash-Lite",
         "api_provider": "google",
         "api_id": "gemini-2.5-flash-lite", 
-    },
-    "deepseek-r1": {
+        "context_window": 1048576,
+    }),
+    "deepseek-r1": MappingProxyType({
         "label": "DeepSeek R1",
         "api_provider": "together",
         "api_id": "deepseek-ai/DeepSeek-R1-0528-tput",
-    }
-}
+        "context_window": 163840,
+        "reasoning": True,
+    }),
+})
 
-PROVIDERS = {
-    "together": {"name": "Together AI"},
-    "google": {"name": "Google AI"}
-}
+PROVIDERS = MappingProxyType({
+    "together": MappingProxyType({"name": "Together AI"}),
+    "google": MappingProxyType({"name": "Google AI"}),
+})
@@ -1,15 +1,20 @@
 # core/prompts.py
 import re
+from typing import Final
 
 # --- Constants ---
 SEARCH_START = "<<<<<<< SEARCH"
 DIVIDER = "======="
 REPLACE_END = ">>>>>>> REPLACE"
+# Output token caps per request path. Full pages need the whole budget, a patch
+# for a single element does not.
+MAX_TOKENS_PAGE = 8192
+MAX_TOKENS_ELEMENT_PATCH = 4096
 # REMOVED: MAX_REQUESTS_PER_IP constant
 DEFAULT_HTML = """<!DOCTYPE html><html lang="en"><head><title>NeuroArti Studio</title><meta name="viewport" content="width=device-width, initial-scale=1.0" /><meta charset="utf-8"><script src="https://cdn.tailwindcss.com"><\/script></head><body class="flex justify-center items-center h-screen overflow-hidden bg-gray-900 font-sans text-center px-6 relative"><div class="relative z-10"><span class="text-xs rounded-full mb-3 inline-block px-3 py-1 border border-indigo-500/20 bg-indigo-500/15 text-indigo-400 font-medium">✨ Your Creative Canvas</span><h1 class="text-4xl lg:text-6xl font-bold text-white"><span class="text-2xl lg:text-4xl text-gray-400 block font-medium mb-2">Welcome to NeuroArti Studio</span>Bring your vision to life.</h1></div><div class="absolute inset-0 -z-10 pointer-events-none"><div class="w-1/2 h-1/2 bg-gradient-to-r from-cyan-500 to-blue-500 opacity-20 blur-3xl absolute bottom-0 left-10 rounded-full"></div><div class="w-1/3 h-1/2 bg-gradient-to-r from-purple-500 to-pink-500 opacity-10 blur-3xl absolute top-0 right-10 rounded-full"></div></div></body></html>"""
 
 # --- System Prompts ---
-INITIAL_SYSTEM_PROMPT = """
+INITIAL_SYSTEM_PROMPT: Final[str] = """
 You are an expert UI/UX designer and frontend developer.
 Your mission is to create a complete, single HTML file based on the user's request.
 **Core Directives:**
@@ -20,7 +25,16 @@ Your mission is to create a complete, single HTML file based on the user's reque
 5.  **Quality and Creativity:** Do not create basic, boring layouts. Elaborate on the user's prompt to produce something visually appealing, modern, and unique.
 """
 
-FOLLOW_UP_SYSTEM_PROMPT = f"""
+# Fixed parts of the follow-up user prompts. Both kinds of update open with the
+# current document, the part that stays the same across successive edits of a
+# page, and end with the request-specific text, so providers can serve the
+# shared prefix from their prompt cache.
+CURRENT_HTML_HEADER: Final[str] = "The current HTML document is:\n```html\n"
+CURRENT_HTML_FOOTER: Final[str] = "\n```\n\n"
+ELEMENT_UPDATE_PREAMBLE: Final[str] = "You are modifying a single element within an existing HTML file based on the user's request.\n\n"
+ELEMENT_UPDATE_CONSTRAINT: Final[str] = "CRITICAL: You must ONLY update the following specific element, NOTHING ELSE:\n\n"
+
+FOLLOW_UP_SYSTEM_PROMPT: Final[str] = f"""
 You are an expert web developer specializing in precise code modifications on an existing HTML file.
 Your task is to act as a patch generator. You MUST output ONLY the changes required using the specified SEARCH/REPLACE block format.
 
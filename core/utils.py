@@ -1,43 +1,168 @@
 # core/utils.py
 import re
-from bs4 import BeautifulSoup, Comment
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from bs4 import BeautifulSoup, NavigableString, CData
+from lxml import etree, html as lxml_html
 from core.prompts import DEFAULT_HTML, SEARCH_START, DIVIDER, REPLACE_END
 
 # REMOVED: ip_address_map dictionary and ip_limiter function
 
+logger = logging.getLogger(__name__)
+# Search blocks can hold most of a page; log only their opening characters.
+_LOG_SNIPPET_CHARS = 200
+
+# Compiled once at import instead of on every patch request.
+_PATCH_BLOCK_RE = re.compile(f"{re.escape(SEARCH_START)}(.*?){re.escape(DIVIDER)}(.*?){re.escape(REPLACE_END)}", re.DOTALL)
+_DOCTYPE_RE = re.compile(r'<!doctype', re.IGNORECASE)
+# The doctype libxml2 reports for a document that has none of its own.
+_LIBXML2_DEFAULT_DOCTYPE = '<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.0 Transitional//EN" "http://www.w3.org/TR/REC-html40/loose.dtd">'
+
+# lxml parsers are reusable but not thread-safe, and HTML is parsed in worker
+# threads, so each thread keeps its own parser.
+_parser_local = threading.local()
+
+def _html_parser() -> lxml_html.HTMLParser:
+    parser = getattr(_parser_local, "parser", None)
+    if parser is None:
+        parser = _parser_local.parser = lxml_html.HTMLParser(recover=True, remove_comments=False, remove_blank_text=False)
+    return parser
+
+def _element_by_id_xpath() -> etree.XPath:
+    """Per-thread compiled `//*[@id=$id]` lookup, so the expression is parsed once per thread."""
+    xpath = getattr(_parser_local, "element_by_id", None)
+    if xpath is None:
+        xpath = _parser_local.element_by_id = etree.XPath('//*[@id=$id]')
+    return xpath
+
+def _normalize_html_text(html_str: str) -> str:
+    """Reduces an HTML document to its visible text with whitespace collapsed."""
+    if not html_str: return ""
+    soup = BeautifulSoup(html_str, 'lxml')
+    # One walk over the tree, keeping exactly the strings get_text() would:
+    # comments, doctypes and script/style contents are other string subclasses.
+    text = ''.join(node.strip() for node in soup.descendants if type(node) in (NavigableString, CData))
+    return ' '.join(text.split())
+
+# The template never changes, so normalize it once rather than on every request.
+_DEFAULT_HTML_TEXT = _normalize_html_text(DEFAULT_HTML)
+
+# Verdicts for pages already compared, keyed by a digest of the page so the
+# pages themselves are not kept alive. Clients resend the same page with each
+# new prompt, so repeats are common.
+_SAME_HTML_CACHE_SIZE = 256
+_same_html_cache: OrderedDict[bytes, bool] = OrderedDict()
+_same_html_lock = threading.Lock()
+
 def is_the_same_html(current_html: str) -> bool:
     """Normalizes and compares HTML content to the default template."""
-    def normalize(html_str: str) -> str:
-        if not html_str: return ""
-        soup = BeautifulSoup(html_str, 'html.parser')
-        for comment in soup.find_all(string=lambda text: isinstance(text, Comment)):
-            comment.extract()
-        return ' '.join(soup.get_text(strip=True).split())
-    
-    return normalize(DEFAULT_HTML) == normalize(current_html)
+    if current_html == DEFAULT_HTML:
+        return True
+    digest = hashlib.blake2b(current_html.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+    with _same_html_lock:
+        verdict = _same_html_cache.get(digest)
+        if verdict is not None:
+            _same_html_cache.move_to_end(digest)
+            return verdict
+    verdict = _DEFAULT_HTML_TEXT == _normalize_html_text(current_html)
+    with _same_html_lock:
+        _same_html_cache[digest] = verdict
+        while len(_same_html_cache) > _SAME_HTML_CACHE_SIZE:
+            _same_html_cache.popitem(last=False)
+    return verdict
 
 def apply_diff_patch(original_html: str, patch_instructions: str) -> str:
     """
     Applies a series of search-and-replace patches to an HTML string.
     """
-    if not patch_instructions or SEARCH_START not in patch_instructions:
-        print("Warning: No valid patch instructions found in AI response. Returning original HTML.")
+    # A single regex pass both validates and extracts the blocks; a separate
+    # substring probe for SEARCH_START would scan the response twice.
+    matches = list(_PATCH_BLOCK_RE.finditer(patch_instructions)) if patch_instructions else []
+    if not matches:
+        logger.warning("No valid patch instructions found in AI response. Returning original HTML.")
         return original_html
         
     modified_html = original_html
-    pattern = re.compile(f"{re.escape(SEARCH_START)}(.*?){re.escape(DIVIDER)}(.*?){re.escape(REPLACE_END)}", re.DOTALL)
-    
-    matches = list(pattern.finditer(patch_instructions))
-    if not matches:
-        return original_html
         
     for match in reversed(matches):
         search_block = match.group(1).strip('\r\n')
         replace_block = match.group(2).strip('\r\n')
         
-        if search_block in modified_html:
-            modified_html = modified_html.replace(search_block, replace_block, 1)
+        # One scan locates the block; splicing avoids a second scan by str.replace.
+        block_start = modified_html.find(search_block)
+        if block_start != -1:
+            modified_html = modified_html[:block_start] + replace_block + modified_html[block_start + len(search_block):]
         else:
-            print(f"Warning: Search block not found in HTML. Skipping patch.\nBlock: {search_block}")
+            logger.warning("Search block not found in HTML. Skipping patch. Block (%d chars): %r", len(search_block), search_block[:_LOG_SNIPPET_CHARS])
             
     return modified_html
+
+def is_complete_patch(patch_instructions: str) -> bool:
+    """
+    True when the response holds at least one SEARCH block and every block is
+    closed. A reply cut off by max_tokens ends inside its last block.
+    """
+    opened = patch_instructions.count(SEARCH_START)
+    return opened > 0 and opened == patch_instructions.count(REPLACE_END)
+
+def score_patch(original_html: str, patch_instructions: str) -> tuple[int, int]:
+    """
+    Ranks candidate patches for the same page: (blocks whose SEARCH text is
+    found in the page, minus blocks that are not). Higher is better; a patch
+    with no valid blocks scores (0, 0).
+    """
+    found = missing = 0
+    for match in _PATCH_BLOCK_RE.finditer(patch_instructions or ""):
+        if match.group(1).strip('\r\n') in original_html:
+            found += 1
+        else:
+            missing += 1
+    return found, -missing
+
+def apply_page_update(original_html: str, patch_instructions: str, element_id: str | None = None) -> str:
+    """
+    Applies the model's patch and strips the temporary element id, if any.
+    A top-level function so it can be shipped to a process pool.
+    """
+    updated_html = apply_diff_patch(original_html, patch_instructions)
+    if element_id:
+        updated_html = remove_element_id(updated_html, element_id)
+    return updated_html
+
+def output_token_budget(source_html: str, cap: int, copies: int = 1, floor: int = 1024) -> int:
+    """
+    Sizes max_tokens from the markup the model has to write back, at roughly
+    three characters per token, plus headroom for growth. Never exceeds `cap`.
+    """
+    return min(cap, max(floor, copies * len(source_html) // 3 + 256))
+
+def remove_element_id(html_str: str, element_id: str) -> str:
+    """
+    Removes the temporary id the editor assigned to the selected element.
+    Uses lxml's C parser; BeautifulSoup is only a fallback for input lxml rejects.
+    """
+    # The model is told to drop the temporary id itself, so usually there is
+    # nothing left to remove and the page need not be parsed at all.
+    if element_id not in html_str:
+        return html_str
+    try:
+        root = lxml_html.document_fromstring(html_str, parser=_html_parser())
+    except (etree.ParserError, ValueError) as e:
+        logger.warning("lxml could not parse HTML (%s). Falling back to BeautifulSoup.", e)
+        soup = BeautifulSoup(html_str, 'lxml')
+        target_element = soup.find(id=element_id)
+        if target_element:
+            del target_element['id']
+        return str(soup)
+
+    for target_element in _element_by_id_xpath()(root, id=element_id)[:1]:
+        del target_element.attrib['id']
+    # Serializing the tree keeps the page's doctype and any comments around it,
+    # but for a page without a doctype libxml2 reports, and would write, an
+    # HTML 4 one. Only that value needs a look at the source to tell them apart.
+    tree = root.getroottree()
+    if tree.docinfo.doctype != _LIBXML2_DEFAULT_DOCTYPE or _DOCTYPE_RE.search(html_str):
+        return lxml_html.tostring(tree, encoding='unicode')
+    return lxml_html.tostring(root, encoding='unicode')
@@ -1,41 +1,114 @@
 # main.py
 import os
 import re
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from typing import AsyncGenerator
-from bs4 import BeautifulSoup
-from core.ai_services import generate_code, stream_code
+from core.ai_services import cache_response, generate_code, generate_code_batch, stream_code, http_client, semantic_cache
 from core.prompts import (
     INITIAL_SYSTEM_PROMPT,
     FOLLOW_UP_SYSTEM_PROMPT,
-    SEARCH_START
+    SEARCH_START,
+    CURRENT_HTML_HEADER,
+    CURRENT_HTML_FOOTER,
+    ELEMENT_UPDATE_PREAMBLE,
+    ELEMENT_UPDATE_CONSTRAINT,
+    MAX_TOKENS_PAGE,
+    MAX_TOKENS_ELEMENT_PATCH
 )
 from core.models import MODELS
 from core.utils import (
     is_the_same_html,
-    apply_diff_patch,
+    apply_page_update,
+    score_patch,
+    is_complete_patch,
+    output_token_budget,
 )
 
 load_dotenv()
 
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(), format="%(levelname)s: %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+# Pages at least this large are patched in a separate process, so parsing them
+# uses another core instead of contending for this worker's GIL.
+PROCESS_POOL_MIN_CHARS = 100_000
+# Workers are spawned lazily on first use; "spawn" avoids forking a process
+# that is running an event loop and threads.
+html_process_pool = ProcessPoolExecutor(
+    max_workers=min(4, os.cpu_count() or 1),
+    mp_context=multiprocessing.get_context("spawn"),
+)
+
+# Hard ceilings on request fields, so one oversized body cannot tie up a worker.
+MAX_HTML_CHARS = 1_048_576
+MAX_PROMPT_CHARS = 20_000
+# Sampling temperature per patch candidate; the first keeps the default so it
+# can be served from the cache. Sized to n_candidates' upper bound.
+_CANDIDATE_TEMPERATURES = (None, 0.5, 0.8, 1.0)
+
 # --- Pydantic Models ---
 class AskAiPostRequest(BaseModel):
-    prompt: str
+    model_config = ConfigDict(extra='ignore', frozen=True)
+
+    prompt: str = Field(max_length=MAX_PROMPT_CHARS)
     model: str
-    html: str | None = None
+    html: str | None = Field(default=None, max_length=MAX_HTML_CHARS)
+    # Ask for a fresh generation instead of a cached response.
+    no_cache: bool = False
+
+class AskAiBatchRequest(BaseModel):
+    model_config = ConfigDict(extra='ignore', frozen=True)
+
+    items: list[AskAiPostRequest] = Field(min_length=1, max_length=16)
 
 class AskAiPutRequest(BaseModel):
-    prompt: str
+    model_config = ConfigDict(extra='ignore', frozen=True)
+
+    prompt: str = Field(max_length=MAX_PROMPT_CHARS)
     model: str
-    html: str
-    selectedElementHtml: str | None = None
+    html: str = Field(max_length=MAX_HTML_CHARS)
+    selectedElementHtml: str | None = Field(default=None, max_length=MAX_HTML_CHARS)
     elementIdToReplace: str | None = None
+    no_cache: bool = False
+    # Generate several patches concurrently and keep the one that applies best.
+    n_candidates: int = Field(default=1, ge=1, le=4)
+
+# Response models: FastAPI serializes these straight to JSON bytes through
+# pydantic-core, without going through a dict and the json module.
+class AskAiPutResponse(BaseModel):
+    ok: bool
+    html: str
+
+class AskAiBatchItem(BaseModel):
+    ok: bool
+    html: str | None = None
+    error: str | None = None
+
+class AskAiBatchResponse(BaseModel):
+    ok: bool
+    items: list[AskAiBatchItem]
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if semantic_cache is not None:
+        # Load the embedding model at startup rather than on the first build.
+        await asyncio.to_thread(semantic_cache.embed, "warm up")
+    yield
+    # The pooled provider client lives for the whole process; close it on shutdown.
+    await http_client.aclose()
+    html_process_pool.shutdown(cancel_futures=True)
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -43,24 +116,49 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Level 5 keeps most of the size win of the default 9 at a fraction of the CPU.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# Compiled once; the stream generator probes them on every chunk.
+_HTML_START_RE = re.compile(r'<!DOCTYPE html>|<html.*?>', re.IGNORECASE | re.DOTALL)
+_HTML_END_RE = re.compile(r'</html>', re.IGNORECASE)
+_HTML_OPEN_RE = re.compile(r'<html', re.IGNORECASE)
+# A start marker split across chunks begins within this many trailing characters.
+_HTML_START_LOOKBACK = len('<!DOCTYPE html>') - 1
+# Likewise for a closing tag split between the held-back text and a new chunk.
+_HTML_END_LOOKBACK = len('</html>') - 1
 
 async def stream_html_generator(ai_stream_coroutine) -> AsyncGenerator[str, None]:
     ai_stream = await ai_stream_coroutine
     buffer = ""
+    scan_from = 0
     html_started = False
     html_ended = False
     async for chunk in ai_stream:
         if html_ended: continue
         buffer += chunk
+        # Text held back from earlier chunks was already searched for the end;
+        # only the new chunk (and a possible split tag) can contain it. Minified
+        # pages arrive without newlines, so the held-back text can be long.
+        end_from = max(0, len(buffer) - len(chunk) - _HTML_END_LOOKBACK)
         if not html_started:
-            match = re.search(r'<!DOCTYPE html>|<html.*?>', buffer, re.IGNORECASE | re.DOTALL)
+            match = _HTML_START_RE.search(buffer, scan_from)
             if match:
                 html_started = True
-                content_to_yield = buffer[match.start():]
-                buffer = ""
-                yield content_to_yield
+                # Keep the page in the buffer so the end check below also runs
+                # on this chunk: a cached response arrives as a single chunk
+                # holding the whole page and whatever the model wrote after it.
+                buffer = buffer[match.start():]
+                end_from = 0
+            else:
+                # Reasoning models can emit a long preamble before the page.
+                # Only an unterminated <html ...> tag or a marker cut off at
+                # the end can still complete, so resume from there next time
+                # rather than rescanning the whole preamble on every chunk.
+                pending = _HTML_OPEN_RE.search(buffer, scan_from)
+                scan_from = pending.start() if pending else max(scan_from, len(buffer) - _HTML_START_LOOKBACK)
         if html_started:
-            end_match = re.search(r'</html>', buffer, re.IGNORECASE)
+            end_match = _HTML_END_RE.search(buffer, end_from)
             if end_match:
                 html_ended = True
                 content_to_yield = buffer[:end_match.end()]
@@ -74,44 +172,146 @@ async def stream_html_generator(ai_stream_coroutine) -> AsyncGenerator[str, None
     if html_started and not html_ended and buffer:
         yield buffer
 
+def extract_html_document(text: str) -> str:
+    """Non-streaming counterpart of stream_html_generator: the page from its start marker through </html>."""
+    match = _HTML_START_RE.search(text)
+    if not match:
+        return ""
+    end_match = _HTML_END_RE.search(text, match.start())
+    return text[match.start():end_match.end() if end_match else len(text)]
+
+async def build_user_prompt(body: AskAiPostRequest) -> tuple[str, bool]:
+    """Returns the user prompt for a build and whether it includes the current page."""
+    # Comparing against the template parses the whole page; keep that off the event loop.
+    html_context = body.html if body.html and not await asyncio.to_thread(is_the_same_html, body.html) else None
+    if html_context:
+        return f"Here is my current HTML code:\n\n```html\n{html_context}\n```\n\nNow, please create a new design based on this HTML and my request: {body.prompt}", True
+    return f"My request is: {body.prompt}", False
+
 @app.post("/api/ask-ai")
 async def ask_ai_post(request: Request, body: AskAiPostRequest):
     # REMOVED: Rate limit check
     if body.model not in MODELS: raise HTTPException(status_code=400, detail="Invalid model selected")
-    html_context = body.html if body.html and not is_the_same_html(body.html) else None
-    user_prompt = f"My request is: {body.prompt}"
-    if html_context:
-        user_prompt = f"Here is my current HTML code:\n\n```html\n{html_context}\n```\n\nNow, please create a new design based on this HTML and my request: {body.prompt}"
+    user_prompt, has_context = await build_user_prompt(body)
     
-    ai_stream_coro = stream_code(INITIAL_SYSTEM_PROMPT, user_prompt, body.model)
-    return StreamingResponse(stream_html_generator(ai_stream_coro), media_type="text/plain; charset=utf-8")
+    # Only prompt-only builds may reuse a near-duplicate's page.
+    ai_stream_coro = stream_code(
+        INITIAL_SYSTEM_PROMPT, user_prompt, body.model,
+        use_cache=not body.no_cache,
+        semantic_text=None if has_context else body.prompt,
+    )
+    # Tell browsers and reverse proxies (nginx honours X-Accel-Buffering) not to
+    # buffer the stream, so tokens reach the client as soon as they are yielded.
+    return StreamingResponse(
+        stream_html_generator(ai_stream_coro),
+        media_type="text/plain; charset=utf-8",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/ask-ai/batch", response_model_exclude_none=True)
+async def ask_ai_batch(request: Request, body: AskAiBatchRequest) -> AskAiBatchResponse:
+    """
+    Builds several pages in one request. The upstream calls run concurrently,
+    so the batch takes about as long as its slowest page; a failing item is
+    reported in place without failing the others.
+    """
+    for item in body.items:
+        if item.model not in MODELS: raise HTTPException(status_code=400, detail=f"Invalid model selected: {item.model}")
+    user_prompts = [user_prompt for user_prompt, _ in await asyncio.gather(*(build_user_prompt(item) for item in body.items))]
+    # Replies are cached only once they are known to hold a page.
+    results = await generate_code_batch([
+        {"system_prompt": INITIAL_SYSTEM_PROMPT, "user_prompt": user_prompt, "model_key": item.model,
+         "use_cache": not item.no_cache, "cache_result": False}
+        for item, user_prompt in zip(body.items, user_prompts)
+    ])
+
+    items = []
+    for item, user_prompt, result in zip(body.items, user_prompts, results):
+        if isinstance(result, BaseException):
+            detail = result.detail if isinstance(result, HTTPException) else str(result)
+            items.append(AskAiBatchItem(ok=False, error=detail))
+            continue
+        html = extract_html_document(result)
+        if html:
+            cache_response(INITIAL_SYSTEM_PROMPT, user_prompt, item.model, MAX_TOKENS_PAGE, result)
+            items.append(AskAiBatchItem(ok=True, html=html))
+        else:
+            items.append(AskAiBatchItem(ok=False, error="AI response did not contain an HTML document."))
+    return AskAiBatchResponse(ok=True, items=items)
 
 @app.put("/api/ask-ai")
-async def ask_ai_put(request: Request, body: AskAiPutRequest):
+async def ask_ai_put(request: Request, body: AskAiPutRequest) -> AskAiPutResponse:
     # REMOVED: Rate limit check
     if not body.html: raise HTTPException(status_code=400, detail="HTML content is required for an update.")
     if body.model not in MODELS: raise HTTPException(status_code=400, detail="Invalid model selected")
     
     try:
         user_prompt = ""
+        max_tokens = MAX_TOKENS_PAGE
+        # The page comes first and the instruction last: repeat edits of the
+        # same page then share everything up to the instruction.
+        document_block = f"{CURRENT_HTML_HEADER}{body.html}{CURRENT_HTML_FOOTER}"
 
         if body.elementIdToReplace and body.selectedElementHtml:
-            print(f"INFO: Handling targeted element update for ID: {body.elementIdToReplace}")
+            logger.info("Handling targeted element update for ID: %s", body.elementIdToReplace)
             user_prompt = (
-                "You are modifying a single element within an existing HTML file based on the user's request.\n\n"
-                f"The FULL current HTML code is: \n```html\n{body.html}\n```\n\n"
-                "CRITICAL: You must ONLY update the following specific element, NOTHING ELSE:\n\n"
+                f"{document_block}"
+                f"{ELEMENT_UPDATE_PREAMBLE}"
+                f"{ELEMENT_UPDATE_CONSTRAINT}"
                 f"```html\n{body.selectedElementHtml}\n```\n\n"
                 f"The user's instruction for the change is: '{body.prompt}'"
             )
+            # The patch echoes the element in its SEARCH block and rewrites it in
+            # REPLACE, so budget for two copies instead of the full cap. An element
+            # too large for the element cap keeps the full cap rather than being
+            # cut off, and so do reasoning models, which spend tokens thinking first.
+            if not MODELS[body.model].get("reasoning"):
+                estimate = output_token_budget(body.selectedElementHtml, MAX_TOKENS_PAGE, copies=2)
+                if estimate <= MAX_TOKENS_ELEMENT_PATCH:
+                    max_tokens = estimate
         else:
-            print("INFO: Handling global page update.")
+            logger.info("Handling global page update.")
             user_prompt = (
-                f"The current HTML document is:\n```html\n{body.html}\n```\n\n"
+                f"{document_block}"
                 f"My request for a global page update is: '{body.prompt}'"
             )
         
-        patch_instructions = await generate_code(FOLLOW_UP_SYSTEM_PROMPT, user_prompt, body.model)
+        # Nothing is cached until the patch is known to be complete, or a
+        # cut-off reply would come back on every retry.
+        # Also returns whether the patch was sampled at the default temperature:
+        # only such a patch may stand in for the cached default answer.
+        async def generate_patch(max_tokens: int) -> tuple[str, bool]:
+            if body.n_candidates == 1:
+                return await generate_code(FOLLOW_UP_SYSTEM_PROMPT, user_prompt, body.model, max_tokens=max_tokens, use_cache=not body.no_cache, cache_result=False), True
+            # Only the first candidate may come from the cache; the others are
+            # fresh samples at rising temperatures, so they actually differ.
+            results = await generate_code_batch([
+                {"system_prompt": FOLLOW_UP_SYSTEM_PROMPT, "user_prompt": user_prompt, "model_key": body.model,
+                 "max_tokens": max_tokens, "use_cache": i == 0 and not body.no_cache,
+                 "temperature": temperature, "cache_result": False}
+                for i, temperature in enumerate(_CANDIDATE_TEMPERATURES[:body.n_candidates])
+            ])
+            candidates = [(i, result) for i, result in enumerate(results) if isinstance(result, str)]
+            if not candidates:
+                raise results[0]
+            # Scoring scans the page once per SEARCH block; keep it off the event loop.
+            scores = await asyncio.gather(*(asyncio.to_thread(score_patch, body.html, c) for _, c in candidates))
+            ranked = [((is_complete_patch(c), score), i, c) for score, (i, c) in zip(scores, candidates)]
+            _, best_index, best = max(ranked, key=lambda entry: entry[0])
+            return best, best_index == 0
+
+        patch_instructions, default_temperature = await generate_patch(max_tokens)
+        if SEARCH_START in patch_instructions and not is_complete_patch(patch_instructions) and max_tokens < MAX_TOKENS_PAGE:
+            # A patch that started but never finished was most likely cut off by
+            # the reduced budget; try once more with the full cap instead of
+            # applying half a patch. A reply with no patch at all is not retried.
+            logger.warning("Patch incomplete with max_tokens=%d; retrying with %d.", max_tokens, MAX_TOKENS_PAGE)
+            max_tokens = MAX_TOKENS_PAGE
+            patch_instructions, default_temperature = await generate_patch(max_tokens)
+        if SEARCH_START in patch_instructions and not is_complete_patch(patch_instructions):
+            raise HTTPException(status_code=502, detail="AI response was cut off before the patch was complete. Update failed.")
+        if default_temperature and is_complete_patch(patch_instructions):
+            cache_response(FOLLOW_UP_SYSTEM_PROMPT, user_prompt, body.model, max_tokens, patch_instructions)
         
         patch_start_index = patch_instructions.find(SEARCH_START)
         if patch_start_index == -1:
@@ -119,21 +319,33 @@ async def ask_ai_put(request: Request, body: AskAiPutRequest):
         
         cleaned_patch = patch_instructions[patch_start_index:]
         
-        updated_html = apply_diff_patch(body.html, cleaned_patch)
-
-        if body.elementIdToReplace:
-            soup = BeautifulSoup(updated_html, 'lxml')
-            target_element = soup.find(id=body.elementIdToReplace)
-            if target_element:
-                del target_element['id']
-            updated_html = str(soup)
+        # Patching and re-parsing a large page is CPU work; run it off the event
+        # loop so other requests keep being served meanwhile.
+        if len(body.html) >= PROCESS_POOL_MIN_CHARS:
+            updated_html = await asyncio.get_running_loop().run_in_executor(
+                html_process_pool, apply_page_update, body.html, cleaned_patch, body.elementIdToReplace
+            )
+        else:
+            updated_html = await asyncio.to_thread(apply_page_update, body.html, cleaned_patch, body.elementIdToReplace)
 
-        return JSONResponse(content={"ok": True, "html": updated_html})
+        return AskAiPutResponse(ok=True, html=updated_html)
         
+    except HTTPException:
+        # Already carries the right status (e.g. 413 for an oversized page).
+        raise
     except Exception as e:
-        print(f"ERROR during update: {e}")
+        logger.error("Error during update: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to apply updates: {str(e)}")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", 8000)),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.environ.get("WEB_CONCURRENCY", 4)),
+        # Room for connection bursts while every worker is busy streaming.
+        backlog=2048,
+    )